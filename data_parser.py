@@ -1,17 +1,40 @@
+import os
 import hashlib
-import json
-from collections import defaultdict
-from typing import Any
-from datetime import datetime
+from operator import itemgetter
+from datetime import date
+import orjson
+from dotenv import load_dotenv
 
-from raw_schedule_data_fetch import get_raw_schedule_data
+from raw_schedule_data_fetch import get_raw_schedule_data_for_weeks
+
+
+# Load .env
+load_dotenv()
+
+# Hash used for the lesson IDs (the UIDs of the calendar events)
+# "md5" keeps the UIDs of already synced events, "blake2b" is faster but gives new UIDs
+LESSON_ID_HASH = os.getenv("LESSON_ID_HASH", "md5").lower()
+
+if LESSON_ID_HASH not in ("md5", "blake2b"):
+    raise ValueError("LESSON_ID_HASH must be either 'md5' or 'blake2b'")
+
+
+def _new_lesson_hasher(data: bytes = b""):
+    """Get a new hash object for the lesson IDs (both give a 32 character hexdigest)
+
+    The IDs aren't used for security, so usedforsecurity=False lets FIPS builds
+    of OpenSSL skip their slower (or refused) MD5 path.
+    """
+    if LESSON_ID_HASH == "blake2b":
+        return hashlib.blake2b(data, digest_size=16, usedforsecurity=False)
+    return hashlib.md5(data, usedforsecurity=False)
 
 def get_weekday_number() -> int:
     """Get today's weekday number"""
-    return datetime.today().weekday()
+    return date.today().weekday()
 
 def get_lesson_id(group_name: str, week: int, lesson_day: int, lesson_nr: int, lesson_name: str, lesson_type: str, teacher: str, debug: bool = False):
-    f"""Returning a 32 character hash created using MD5 and a string from the given args
+    f"""Returning a 32 character hash created using LESSON_ID_HASH (MD5 by default) and a string from the given args
 
     Args:
         lesson_day (int): lesson day
@@ -25,9 +48,9 @@ def get_lesson_id(group_name: str, week: int, lesson_day: int, lesson_nr: int, l
     Returns:
         string: [your_hash]@usarb-schedule.local
     """
-    # Get string for hash transform and transform it using MD5
+    # Get string for hash transform and transform it using LESSON_ID_HASH
     to_hash = f"{group_name}{week}{lesson_day}{lesson_nr}{lesson_name}{lesson_type}{teacher}"
-    hash = hashlib.md5(to_hash.encode()).hexdigest()[:32]
+    hash = _new_lesson_hasher(to_hash.encode()).hexdigest()
     
     # Debug
     if debug:
@@ -35,7 +58,43 @@ def get_lesson_id(group_name: str, week: int, lesson_day: int, lesson_nr: int, l
     
     return hash
 
-def get_schedule_for_snapshot(group_name: str, *weeks: int, debug: bool = False):
+def get_lesson_ids_batch(records, debug: bool = False) -> list[str]:
+    """Returning the lesson IDs for many lessons at once, in the same order as `records`
+
+    Args:
+        records (iterable): tuples of (group_name, week, lesson_day, lesson_nr, lesson_name, lesson_type, teacher)
+        debug (bool, optional): debug. Defaults to False.
+
+    Returns:
+        list[str]: the 32 character hashes, same as get_lesson_id() would return for every record
+    """
+    # Bind the hasher once instead of looking it up for every lesson
+    new_hasher = _new_lesson_hasher
+
+    # The "group_name + week" prefix is hashed only when it changes, every lesson
+    # starts from a copy of that hash state and adds just its own fields
+    prefix_key = None
+    prefix_hasher = None
+    hashes = []
+
+    # Hash every record, keeping the order of the records
+    for group_name, week, lesson_day, lesson_nr, lesson_name, lesson_type, teacher in records:
+        if (group_name, week) != prefix_key:
+            prefix_key = (group_name, week)
+            prefix_hasher = new_hasher(f"{group_name}{week}".encode())
+
+        # Same bytes as get_lesson_id() hashes, so the IDs don't change
+        hasher = prefix_hasher.copy()
+        hasher.update(f"{lesson_day}{lesson_nr}{lesson_name}{lesson_type}{teacher}".encode())
+        hashes.append(hasher.hexdigest())
+
+    # Debug
+    if debug:
+        print(f"DEBUG: {hashes}")
+
+    return hashes
+
+def get_schedule_for_snapshot(group_name: str, *weeks: int, debug: bool = False, refresh: bool = False):
     """All the specifications/keywords we need:
         cours_nr -> lesson number (1 - 8)
         cours_name -> name of the course/class (e.g. Math)
@@ -48,6 +107,7 @@ def get_schedule_for_snapshot(group_name: str, *weeks: int, debug: bool = False)
     Args:
         group_name (str): name of your group (the group you're in)
         debug (bool, optional): debug. Defaults to False.
+        refresh (bool, optional): skip the on-disk schedule cache. Defaults to False.
 
     Returns:
         schedule: Your class schedule
@@ -58,61 +118,52 @@ def get_schedule_for_snapshot(group_name: str, *weeks: int, debug: bool = False)
         weeks = weeks[0]
     
     # Create a dict for saving schedule
-    schedule = defaultdict[Any, defaultdict[Any, dict]](lambda: defaultdict[Any, dict](dict))
+    schedule: dict[int, dict[str, dict]] = {}
     
-    for week in weeks:
-        # Get the raw schedule
-        raw_schedule = get_raw_schedule_data(group_name, university_week=week)
-
-        # Create a dict that will save every lesson by thei day (1-7, monday-sunday)
-        lessons_by_day = {
-            1: [],
-            2: [],
-            3: [],
-            4: [],
-            5: [],
-            6: [],
-            7: [],
-        }
-        
-        # Save lessons to lessons_by_day dict
-        for i in raw_schedule["week"]:
-            lessons_by_day[i["day_number"]].append(i)    
-            
-        # DEBUG
-        if debug:
-            print(f"\n\nDEBUG lessons_by_day: {lessons_by_day}")
+    # Get the raw schedules of all the weeks (fetched in parallel)
+    raw_schedules = get_raw_schedule_data_for_weeks(group_name, weeks, refresh=refresh)
+
+    for week, raw_schedule in raw_schedules.items():
 
-        # Loop for saving lessons to schedule (here we're getting all the lessons for a day)
-        for lessons in lessons_by_day.values():
+        # Get the dict where the lessons of this week are saved (weeks are few, lessons are many)
+        week_schedule = schedule.setdefault(week, {})
 
+        # Sort the lessons by their day (1-7, monday-sunday), the sort is stable so the
+        # lessons of a day keep their order
+        lessons = sorted(raw_schedule["week"], key=itemgetter("day_number"))
+
+        # DEBUG
+        if debug:
+            print(f"\n\nDEBUG lessons: {lessons}")
+
+        # Get the hashes of all the lessons of the week in one go
+        lesson_hashes = get_lesson_ids_batch(
+            (group_name, week, lesson["day_number"], lesson["cours_nr"], lesson["cours_name"], lesson["cours_type"], lesson["teacher_name"])
+            for lesson in lessons
+        )
+
+        # Loop for saving lessons to schedule, one by one
+        for lesson, lesson_hash in zip(lessons, lesson_hashes):
+            lesson_day = lesson["day_number"]
+            lesson_nr = lesson["cours_nr"]
+            lesson_name = lesson["cours_name"]
+            lesson_type = lesson["cours_type"]
+            office = lesson["cours_office"]
+            teacher = lesson["teacher_name"]
+            
+            # Write everyting in the schedule dict
+            week_schedule[lesson_hash] = {
+                "lesson_day": lesson_day,
+                "lesson_nr": lesson_nr,
+                "lesson_name": lesson_name,
+                "lesson_type": lesson_type,
+                "office": office,
+                "teacher": teacher,
+            }
+            
             # DEBUG
             if debug:
-                print(f"\n\nDEBUG lessons: {lessons}")
-
-            # Getting the lessons one by one from lessons
-            for lesson in lessons:
-                lesson_day = lesson["day_number"]
-                lesson_nr = lesson["cours_nr"]
-                lesson_name = lesson["cours_name"]
-                lesson_type = lesson["cours_type"]
-                office = lesson["cours_office"]
-                teacher = lesson["teacher_name"]
-                
-                # Get the lesson hash
-                lesson_hash = get_lesson_id(group_name, week, lesson_day, lesson_nr, lesson_name, lesson_type, teacher)
-                
-                # Write everyting in the schedule dict
-                schedule[week][lesson_hash]["lesson_day"] = lesson_day
-                schedule[week][lesson_hash]["lesson_nr"] = lesson_nr
-                schedule[week][lesson_hash]["lesson_name"] = lesson_name
-                schedule[week][lesson_hash]["lesson_type"] = lesson_type
-                schedule[week][lesson_hash]["office"] = office
-                schedule[week][lesson_hash]["teacher"] = teacher
-                
-                # DEBUG
-                if debug:
-                    print(f"\n\nDEBUG schedule by lesson_hash: f{schedule[week][lesson_hash]}")
+                print(f"\n\nDEBUG schedule by lesson_hash: {week_schedule[lesson_hash]}")
 
     # DEBUG
     if debug:
@@ -134,9 +185,13 @@ def save_schedule_to_json(group_name: str, *weeks: int, debug: bool = False):
     # Get schedule
     schedule = get_schedule_for_snapshot(group_name, *weeks)
 
-    # Open a default file ("schedule_snapshot.json") and write the schedule
-    with open("schedule_snapshot.json", "w") as f:
-        json.dump(schedule, f, indent=4)
+    # Write the schedule to a temporary file, then rename it over the default file ("schedule_snapshot.json"),
+    # so a crash mid-write never leaves a half written snapshot
+    # (orjson writes bytes, the week numbers are int keys so OPT_NON_STR_KEYS is needed)
+    tmp_path = "schedule_snapshot.json.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(schedule, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+    os.replace(tmp_path, "schedule_snapshot.json")
         
 
 # Local testing
@@ -1,14 +1,22 @@
 import os
-import json
-from re import S
-from typing import Any, Literal, Tuple, overload
+import re
+import hashlib
+import time as time_module
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Literal, Tuple, overload
 from dotenv import load_dotenv
 from datetime import datetime, date, time, timedelta, timezone
-import caldav
-from caldav.davclient import get_davclient
-from caldav.lib.error import NotFoundError
+from zoneinfo import ZoneInfo
+from urllib.parse import unquote
+import orjson
 
-from data_parser import get_raw_schedule_data, get_lesson_id, get_weekday_number
+# caldav is imported where it's used (it pulls in lxml and friends), so scripts that only
+# need the date math or the snapshot don't pay for it
+if TYPE_CHECKING:
+    import caldav
+
+from data_parser import get_raw_schedule_data_for_weeks, get_lesson_id, get_lesson_ids_batch, get_weekday_number
 
 
 # Load .env
@@ -28,10 +36,79 @@ GROUP_NAME=os.getenv("GROUP_NAME")
 # TODO 3. Is it possilbe to check the year and then get those (also add to setting.py)
 # Other constants
 FIRST_DAY = date(2025, 9, 1)
+_FIRST_DAY_ORD = FIRST_DAY.toordinal()
 FIRST_LESSON_TIME = time(8, 0)
+# Lesson times are local to the university, whatever timezone the script runs in
+ACADEMIC_TZ = ZoneInfo("Europe/Chisinau")
+LESSON_DURATION = timedelta(hours=1, minutes=30)
+LESSON_STEP = timedelta(hours=1, minutes=45)
+MAX_LESSON_NR = 8
+
+# Begin and end lines of the ics content of every event (joined once, they never change)
+ICS_CALENDAR_BEGIN = "\r\n".join([
+    "BEGIN:VCALENDAR",
+    "VERSION:2.0",
+    "PRODID:-//USARB Schedule//EN",
+])
+ICS_CALENDAR_END = "\r\n".join([
+    "END:VCALENDAR",
+    "",
+])
+
+# Reconnect to CalDAV after this many idle seconds (iCloud drops idle sessions after ~30 minutes)
+CALDAV_IDLE_TIMEOUT = 25 * 60
+
+# Where the UIDs and content hashes of the synced events are kept (to only upload what changed)
+SYNC_STATE_FILE = "sync_state.json"
+
+# Where the WebDAV-Sync tokens of the calendars are kept (to find the events changed by hand)
+SYNC_TOKEN_FILE = ".sync_token"
+
+# How many events are uploaded at the same time
+MAX_UPLOAD_WORKERS = 8
+
+# iCal escapes (RFC 5545 TEXT values), applied in a single regex pass (\r\n is matched as one newline)
+_ICS_ESCAPES = {
+    "\\": "\\\\",
+    ",": "\\,",
+    ";": "\\;",
+    "\r\n": "\\n",
+    "\r": "\\n",
+    "\n": "\\n",
+}
+_ICS_ESCAPE_RE = re.compile(r"\r\n|[\\,;\r\n]")
+
+
+def _compute_lesson_time(lesson_nr: int) -> Tuple[time, time]:
+    """Compute lesson start and end time by lesson_nr"""
+    # Any date works here, only the time is kept
+    dt = datetime.combine(date(2000, 1, 1), FIRST_LESSON_TIME)
+
+    # Get lesson start and end time
+    lesson_start_time = dt + (lesson_nr - 1) * LESSON_STEP
+    lesson_end_time = lesson_start_time + LESSON_DURATION
+
+    return lesson_start_time.time(), lesson_end_time.time()
+
+
+# Start and end time of every lesson (index = lesson_nr - 1), computed once
+LESSON_TIMES = tuple(_compute_lesson_time(lesson_nr) for lesson_nr in range(1, MAX_LESSON_NR + 1))
 
 
 class CalendarSchedule:
+    __slots__ = (
+        "caldav_url",
+        "username",
+        "password",
+        "calendar_name",
+        "group_name",
+        "debug",
+        "_client",
+        "_principal",
+        "_calendar",
+        "_last_used",
+    )
+
     def __init__(self) -> None:
         "Setting up the environmental variables"
         self.caldav_url = CALDAV_URL
@@ -42,17 +119,44 @@ class CalendarSchedule:
         self.debug: bool = False
         self._client = None
         self._principal = None
+        self._calendar = None
+        self._last_used: float = 0.0
+
+    def __enter__(self) -> "CalendarSchedule":
+        """Connect when entering a `with` block, one CalDAV client is then shared by
+        every request until the block exits"""
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Close the CalDAV client (the next connect() opens a new one)"""
+        if self._client is not None:
+            self._client.close()
+
+        self._client = None
+        self._principal = None
+        self._calendar = None
         
-    def connect(self) -> caldav.Principal:
+    def connect(self) -> "caldav.Principal":
         """Connecting to the calendar
         
         Returns:
             my_principal: Your principal
         """
+        # Drop a connection that sat idle for too long (the server has most likely closed it)
+        if self._principal is not None and time_module.monotonic() - self._last_used > CALDAV_IDLE_TIMEOUT:
+            self.close()
+
         # Reuse existing connection if available
         if self._principal is not None:
+            self._last_used = time_module.monotonic()
             return self._principal
 
+        from caldav.davclient import get_davclient
+
         self._client = get_davclient(
             username=self.username,
             password=self.password,
@@ -62,6 +166,7 @@ class CalendarSchedule:
         try:
             # Get principal from client
             self._principal = self._client.principal()
+            self._last_used = time_module.monotonic()
             print(f"✅ Successfully connected to the calendar.")
 
             # Debug
@@ -76,30 +181,32 @@ class CalendarSchedule:
 
     def _get_lesson_time(self, lesson_nr: int):
         """Get lesson start and end time by lesson_nr"""
-        # Coming a date with first lesson's start time
-        dt = datetime.combine(datetime.today(), FIRST_LESSON_TIME)
-
-        # Get lesson_start_time
-        lesson_start_time = dt + (lesson_nr - 1) * timedelta(hours=1, minutes=45)
-
-        # Get lesson_end_time
-        lesson_end_time = lesson_start_time + timedelta(hours=1, minutes=30)
+        # Look the lesson up in the precomputed table, compute it only if it's out of range
+        if 1 <= lesson_nr <= MAX_LESSON_NR:
+            lesson_start_time, lesson_end_time = LESSON_TIMES[lesson_nr - 1]
+        else:
+            lesson_start_time, lesson_end_time = _compute_lesson_time(lesson_nr)
             
         if self.debug:
-            print(f"\n\nDEBUG: st = {lesson_start_time.time()}, et = {lesson_end_time.time()}")
+            print(f"\n\nDEBUG: st = {lesson_start_time}, et = {lesson_end_time}")
         
-        return lesson_start_time.time(), lesson_end_time.time()
+        return lesson_start_time, lesson_end_time
+
+    def _get_this_week(self, today: date | None = None) -> int:
+        """Get lesson week from today
 
-    def _get_this_week(self) -> int:
-        """Get lesson week from today"""
+        Args:
+            today (date, optional): the date to use as "today" (pass the same one through a whole run). Defaults to date.today().
+        """
         # Get today's date
-        today = datetime.today().date()
+        if today is None:
+            today = date.today()
 
         # Get the day difference
-        days_difference = (today - FIRST_DAY).days
+        days_difference = today.toordinal() - _FIRST_DAY_ORD
         
-        # Calculate week number
-        if get_weekday_number() == 6:
+        # Calculate week number (on sundays we're already looking at the next week)
+        if today.weekday() == 6:
             week_number = (days_difference // 7) + 2
         else:
             week_number = (days_difference // 7) + 1
@@ -116,6 +223,7 @@ class CalendarSchedule:
         week: int | None = ...,
         postpone: int = ...,
         mode: Literal["dates"] = ...,
+        today: date | None = ...,
     ) -> tuple[date, date]: ...
 
     @overload
@@ -124,9 +232,10 @@ class CalendarSchedule:
         week: int | None = ...,
         postpone: int = ...,
         mode: Literal["weeks"] = ...,
+        today: date | None = ...,
     ) -> list[int]: ...
 
-    def _get_date_from_this_week_on(self, week: int | None = None, postpone: int = 3, mode: str = "dates"):
+    def _get_date_from_this_week_on(self, week: int | None = None, postpone: int = 3, mode: str = "dates", today: date | None = None):
         """Get a range of dates, from first day of the university week, to the 
         one calculated by formula week + postpone (e.g. week = 10, postpone = 3)
         returns the range from start of week 10, till then end of week 10 + 3 = 13.
@@ -134,6 +243,7 @@ class CalendarSchedule:
         Args:
             week (int): A week (1-the_end). Defaults to self.get_this_week()
             postpone (int): How many weeks on you want to prolong your calendar. Defaults to 3.
+            today (date, optional): the date "this" week is calculated from. Defaults to date.today().
 
         Returns:
             mode ("dates"): a range of dates from the first day of `week` to the last day of `week + postpone`, OR
@@ -141,7 +251,7 @@ class CalendarSchedule:
         """
         # If no week is given, use "this" week by default
         if week is None:
-            week = self._get_this_week()
+            week = self._get_this_week(today)
             print(f"🚂 week set by default (week = {week}, postpone = {postpone})")
 
         # for mode = "weeks" return the range of weeks
@@ -153,11 +263,11 @@ class CalendarSchedule:
             return list[int](range(week, week + postpone))
 
         # Get the start_date
-        # formula: start_date = FIRST_DAY + 7 * week
-        start_date = FIRST_DAY + timedelta(days=7) * (week - 1)
+        # formula: start_date = FIRST_DAY + 7 * (week - 1) days
+        start_date = date.fromordinal(_FIRST_DAY_ORD + 7 * (week - 1))
 
-        # Get the end_date
-        end_date = (start_date + timedelta(days=7) * postpone) - timedelta(days=1)
+        # Get the end_date (the day before the week after the last one)
+        end_date = date.fromordinal(_FIRST_DAY_ORD + 7 * (week - 1 + postpone) - 1)
 
         # Debug
         if self.debug:
@@ -182,15 +292,15 @@ class CalendarSchedule:
             datetime: the date and the time of a specific lesson
         """
 
-        # Get the date of the lesson using week and day
-        dt = (FIRST_DAY + timedelta(days=7) * (week - 1)) + timedelta(days=day-1)
+        # Get the date of the lesson using week and day (plain integer math on the ordinal)
+        dt = date.fromordinal(_FIRST_DAY_ORD + (week - 1) * 7 + (day - 1))
         
         # Get the time of the lesson using _get_lesson_time method
         lt_start, lt_end = self._get_lesson_time(lesson_nr=lesson_nr)
         
-        # Combine date with lessons start and end time
-        dt_start = datetime.combine(dt, lt_start)
-        dt_end = datetime.combine(dt, lt_end)
+        # Combine date with lessons start and end time (in the university's timezone, not the host's)
+        dt_start = datetime.combine(dt, lt_start, tzinfo=ACADEMIC_TZ)
+        dt_end = datetime.combine(dt, lt_end, tzinfo=ACADEMIC_TZ)
 
         # Convert to utc
         dt_start = dt_start.astimezone(timezone.utc)
@@ -210,15 +320,13 @@ class CalendarSchedule:
 
     def _escape_ics_value(self, value: str) -> str:
         """Escape special characters in iCal values."""
-        # Replace newlines with \n
-        value = value.replace('\r\n', '\\n').replace('\n', '\\n').replace('\r', '\\n')
-        # Escape special characters
-        value = value.replace('\\', '\\\\')
-        value = value.replace(',', '\\,')
-        value = value.replace(';', '\\;')
-        # Replace newlines in multi-line values with proper formatting
-        value = value.replace('\n', '\\n')
-        return value
+        # Most values have nothing to escape, return them as they are
+        if not _ICS_ESCAPE_RE.search(value):
+            return value
+
+        # Escape everything in one pass (backslashes are escaped together with the rest,
+        # so the inserted ones aren't doubled)
+        return _ICS_ESCAPE_RE.sub(lambda match: _ICS_ESCAPES[match.group(0)], value)
     
     # Feature in later update
     # e.g. where we need to make a difference between two schedules
@@ -226,8 +334,8 @@ class CalendarSchedule:
         """Fetching the data from the last schedule snapshot"""
         # Open the json file and load the snapshot into a variable
         try:
-            with open(snapshot_directory, "r") as fp:
-                schedule_snapshot = json.load(fp)
+            with open(snapshot_directory, "rb") as fp:
+                schedule_snapshot = orjson.loads(fp.read())
         except FileNotFoundError:
             print(f"The file \"{snapshot_directory}\" doesn't exist.")
             return None
@@ -238,13 +346,20 @@ class CalendarSchedule:
         
         return schedule_snapshot
     
-    def get_or_create_calendar(self) -> caldav.Calendar:
+    def get_or_create_calendar(self) -> "caldav.Calendar":
         """Get the calendar used for schedule, if none exists, it'll create a new one
         naming it by calendar_name from .env
 
         Returns:
             my_calendar: Your calendar
         """
+        # Reuse the calendar if we already got it with this connection (and it isn't idle for too long)
+        if self._calendar is not None and time_module.monotonic() - self._last_used <= CALDAV_IDLE_TIMEOUT:
+            self._last_used = time_module.monotonic()
+            return self._calendar
+
+        from caldav.lib.error import NotFoundError
+
         # Get my_principal (connect)
         my_principal = self.connect()
 
@@ -260,14 +375,26 @@ class CalendarSchedule:
         if self.debug:
             print(f"\n\nDEBUG: type {type(my_calendar)}")
             print(f"DEBUG: calendar {my_calendar}")
-    
+
+        self._calendar = my_calendar
         return my_calendar
 
-    def sync_schedule(self, group_name: str = None, weeks: list[int] = None):
+    def sync_schedule(self, group_name: str = None, weeks: list[int] = None, refresh: bool = False, force_upload: bool = False) -> bool:
         """Parsing the data from get_schedule(), adding it up to a ics data set and
         add to the calendar itself.
+
+        Args:
+            refresh (bool, optional): skip the on-disk schedule cache, fetch every week again. Defaults to False.
+            force_upload (bool, optional): ignore the sync state, upload every event again (even the unchanged ones).
+                Defaults to False.
+
+        Returns:
+            bool: whether every event was saved and deleted (the failed ones are tried again next sync)
         """
         
+        # Get today once, so the whole sync agrees on it (even across midnight)
+        today = date.today()
+
         # Get my_calendar
         my_calendar = self.get_or_create_calendar()
 
@@ -277,7 +404,7 @@ class CalendarSchedule:
 
         # If no weeks provided, get this week and the next 2
         if weeks is None:
-            weeks = self._get_date_from_this_week_on(postpone=3, mode="weeks",)
+            weeks = self._get_date_from_this_week_on(postpone=3, mode="weeks", today=today)
 
             # Debug
             if self.debug:
@@ -287,69 +414,192 @@ class CalendarSchedule:
         if isinstance(weeks, int):
             weeks = [weeks]
         
-        # Define .ics code for the schedule calendar and make sure to create it every week
-        event_lines = [
-            "BEGIN:VCALENDAR",
-            "VERSION:2.0",
-            "PROID:-//USARB Schedule//EN",
-        ]
+        # Get the raw schedules of all the weeks (fetched in parallel)
+        print(f"🔵 Fetching weeks {', '.join(map(str, weeks))}")
+        my_schedules = get_raw_schedule_data_for_weeks(your_group_name=group_name, weeks=weeks, refresh=refresh)
+
+        # The UID, week and ics content of every lesson (one calendar object per lesson)
+        events: list[tuple[str, int, str]] = []
 
-        # The end lines for ics content
-        event_lines_end = [
-            f"END:VCALENDAR",
-            "", 
-        ]
-        
         # Loop for parsing my_schedule week by week
-        for week in weeks:
+        for week, my_schedule in my_schedules.items():
             # User info
             print(f"🔵 Working on week {week}")
 
-            # Get the raw schedule (as my_schedule) and lessons from it
-            my_schedule = get_raw_schedule_data(your_group_name=group_name, university_week=week)
+            # Get the lessons from the raw schedule (as my_schedule)
             lessons = my_schedule.get("week") or []
 
+            # Get the hashes (UIDs) of all the lessons of the week in one go
+            lesson_ids = get_lesson_ids_batch(
+                (group_name, week, lesson["day_number"], lesson["cours_nr"], lesson["cours_name"], lesson["cours_type"], lesson["teacher_name"])
+                for lesson in lessons
+            )
+
             # Loop for parsing every lesson from a university week
-            for lesson in lessons:
-                # Save the lesson using the save_lesson function
-                self.save_lesson(lesson, group_name, week, event_lines)
-            
-        # Add the end lines to the ics content
-        event_lines.extend(event_lines_end)
+            for lesson, lesson_id in zip(lessons, lesson_ids):
+                # Get the lesson's VEVENT using the save_lesson function and wrap it into a VCALENDAR
+                uid, vevent = self.save_lesson(lesson, group_name, week, lesson_id=lesson_id)
+                events.append((uid, week, self._wrap_ics_calendar(vevent)))
+
+        # Load what the last sync uploaded to this calendar ({uid: {"hash": ..., "week": ...}})
+        calendar_key = str(my_calendar.url)
+        sync_states = self._load_sync_state()
+        prev_state = sync_states.get(calendar_key, {})
+
+        # Only weeks that came back with lessons may delete events, an empty response (e.g. the
+        # portal having a bad moment or an unknown group) would otherwise wipe the whole week
+        synced_weeks = {week for week, my_schedule in my_schedules.items() if my_schedule.get("week")}
+        for week in my_schedules.keys() - synced_weeks:
+            print(f"Week {week} came back empty, its events are left as they are.")
+
+        # Events changed or deleted in the calendar since the last sync (e.g. by hand) are uploaded again
+        edited_uids = self._get_edited_uids(my_calendar, prev_state)
+
+        # Keep only the events that are new or changed since the last sync (on force_upload, all of them)
+        current_state: dict[str, dict] = {}
+        to_upload: list[tuple[str, str]] = []
+        for uid, week, content in events:
+            content_hash = hashlib.blake2b(content.encode("utf-8"), digest_size=16).hexdigest()
+            current_state[uid] = {"hash": content_hash, "week": week}
+
+            if force_upload or uid in edited_uids or prev_state.get(uid, {}).get("hash") != content_hash:
+                to_upload.append((uid, content))
+
+        # Events uploaded by a previous sync for these weeks that aren't in the schedule anymore
+        to_delete = [
+            uid for uid, entry in prev_state.items()
+            if entry.get("week") in synced_weeks and uid not in current_state
+        ]
 
-        # Debug
-        if self.debug:
-            print(f"\n\nDEBUG: ICS Event Lines (end): {event_lines}")
-        
-        # Get the properly formatted ics content
-        content = "\r\n".join(event_lines)
+        # User info
+        print(f"🔵 {len(to_upload)} new/changed, {len(events) - len(to_upload)} unchanged, {len(to_delete)} removed event/events")
+
+        # Upload every event on its own (each is saved under its UID, so a re-sync updates it
+        # instead of creating a duplicate), the uploads are network bound so they run in parallel
+        if to_upload:
+            with ThreadPoolExecutor(max_workers=min(MAX_UPLOAD_WORKERS, len(to_upload))) as executor:
+                results = list(executor.map(lambda event: self._save_event(my_calendar, event[1]), to_upload))
+        else:
+            results = []
+
+        # Delete the removed events
+        deleted = [uid for uid in to_delete if self._delete_event(my_calendar, uid)]
+
+        # Save the new state: the other weeks stay as they were, failed deletes are kept and failed
+        # uploads keep their previous entry (if they had one, so the old event is still tracked),
+        # so both are tried again next time. A failed re-upload of an event edited in the calendar
+        # gets no hash: the sync-token has moved past that edit, so the hash has to force the retry
+        failed_uids = {uid for (uid, _), saved in zip(to_upload, results) if not saved}
+        new_state = {
+            uid: entry for uid, entry in prev_state.items()
+            if entry.get("week") not in synced_weeks or (uid in to_delete and uid not in deleted)
+        }
+        for uid, entry in current_state.items():
+            if uid not in failed_uids:
+                new_state[uid] = entry
+            elif uid in edited_uids:
+                new_state[uid] = {"hash": None, "week": entry["week"]}
+            elif uid in prev_state:
+                new_state[uid] = prev_state[uid]
+        sync_states[calendar_key] = new_state
+        self._save_sync_state(sync_states)
+
+        # Move the sync-token past our own uploads and deletes, so the next sync only sees other changes
+        try:
+            self._get_sync_changes(my_calendar)
+        except Exception as e:
+            print(f"There was a problem updating the sync-token: {e}")
+
+        # User info
+        saved_count = sum(results)
+        if saved_count == len(results) and len(deleted) == len(to_delete):
+            print(f"✅ {saved_count} event/events succesfully saved, {len(deleted)} deleted.")
+            return True
+
+        print(f"There was a problem saving {len(results) - saved_count} of {len(results)} event/events"
+              f" and deleting {len(to_delete) - len(deleted)} of {len(to_delete)}.")
+        return False
+
+    def _load_sync_state(self) -> dict:
+        """Load the UIDs and content hashes uploaded by the last syncs, by calendar URL
+        ({calendar_url: {uid: {"hash": ..., "week": ...}}}, empty if there's none)"""
+        try:
+            with open(SYNC_STATE_FILE, "rb") as fp:
+                state = orjson.loads(fp.read())
+        except FileNotFoundError:
+            return {}
+        except orjson.JSONDecodeError:
+            print(f"The file \"{SYNC_STATE_FILE}\" is broken, every event will be uploaded again.")
+            return {}
+
+        # The old format wasn't split by calendar, there's no telling which calendar it was for
+        if any("hash" in entry for entry in state.values()):
+            print(f"The file \"{SYNC_STATE_FILE}\" has the old format, every event will be uploaded again.")
+            return {}
+
+        return state
+
+    def _save_sync_state(self, state: dict) -> None:
+        """Save the UIDs and content hashes of the synced events, by calendar URL (write and rename, so it's never half written)"""
+        tmp_path = f"{SYNC_STATE_FILE}.tmp"
+        with open(tmp_path, "wb") as fp:
+            fp.write(orjson.dumps(state))
+        os.replace(tmp_path, SYNC_STATE_FILE)
+
+    def _wrap_ics_calendar(self, vevent: str) -> str:
+        "Returns the ics content of a calendar holding the given VEVENT block"
+        return f"{ICS_CALENDAR_BEGIN}\r\n{vevent}\r\n{ICS_CALENDAR_END}"
+
+    def _delete_event(self, my_calendar: "caldav.Calendar", uid: str) -> bool:
+        """Delete the event with the given UID from the calendar, returns whether it's gone"""
+        from caldav.lib.error import NotFoundError
 
-        # Try to save the event
+        try:
+            my_calendar.event_by_uid(uid).delete()
+        except NotFoundError:
+            # Already gone
+            pass
+        except Exception as e:
+            print(f"There was a problem deleting the event {uid}: {e}")
+            return False
+
+        return True
+
+    def _save_event(self, my_calendar: "caldav.Calendar", content: str) -> bool:
+        """Save one event's ics content to the calendar, returns whether it worked"""
         try:
             saved_event = my_calendar.save_event(content.encode("utf-8"))
-            print("✅ Event/Events succesfully created.")
         except Exception as e:
-            print(f"There was a problem saving the event/events: {e}")
+            print(f"There was a problem saving the event: {e}")
+            return False
 
         # Debug
         if self.debug:
             print(f"DEBUG: Saved event data: {saved_event}")
-        
-    def save_lesson(self, lesson: dict, group_name: str, week: int, event_lines: list):
+
+        return True
+
+    def save_lesson(self, lesson: dict, group_name: str, week: int, lesson_id: str | None = None) -> Tuple[str, str]:
+        """Build the ics VEVENT block of a lesson, returns its UID and the block
+
+        Args:
+            lesson_id (str, optional): the lesson's hash, if it was already computed (e.g. by get_lesson_ids_batch). Defaults to None.
+        """
         # Get the data needed from my_schedule dict
         lesson_nr, lesson_name, lesson_type,\
             lesson_day, office, teacher = self.get_lesson_variables(lesson)
 
         # Get lesson's hash (UID)
-        lesson_id = get_lesson_id(
-            group_name, 
-            week, 
-            lesson_day, 
-            lesson_nr, 
-            lesson_name, 
-            lesson_type, 
-            teacher
-        )
+        if lesson_id is None:
+            lesson_id = get_lesson_id(
+                group_name, 
+                week, 
+                lesson_day, 
+                lesson_nr, 
+                lesson_name, 
+                lesson_type, 
+                teacher
+            )
         
         # Get dt_start and dt_end, then convert into a proper form
         dt_start, dt_end = self._get_lesson_date_and_time(week, lesson_day, lesson_nr)
@@ -367,15 +617,16 @@ class CalendarSchedule:
         description_lines = [
             f"Lesson {lesson_nr}",
             f"Type: {lesson_type}",
-            f"Office: {_safe_location}",
+            f"Office: {location}",
             f"Teacher: {teacher}"
         ]
         _safe_description = self._escape_ics_value("\n".join(description_lines))
 
         # Generate ics data
+        uid = f"{lesson_id}@usarb-schedule.local"
         lesson_lines = [
             "BEGIN:VEVENT",
-            f"UID:{lesson_id}@usarb-schedule.local",
+            f"UID:{uid}",
             f"DTSTART:{dt_start}",
             f"DTEND:{dt_end}",
             f"SUMMARY:{_safe_summary}",
@@ -383,13 +634,13 @@ class CalendarSchedule:
             f"LOCATION:{_safe_location}",
             f"END:VEVENT",
         ]
-        
-        # Add event/lesson to the ics data
-        event_lines.extend(lesson_lines)
 
         # Debug
         if self.debug:
             print(f"\n\nDEBUG: ICS Lesson Lines: {lesson_lines}")
+
+        # Get the properly formatted VEVENT block
+        return uid, "\r\n".join(lesson_lines)
     
     def get_lesson_variables(self, lesson: dict):
         """Get all the variables needed from a lesson"""
@@ -404,7 +655,7 @@ class CalendarSchedule:
         return lesson_nr, lesson_name, lesson_type, lesson_day, office, teacher
 
     # This function won't be used in the main process, but it's here for testing purposes
-    def fetch_events(self, my_calendar: caldav.Calendar | None = None) -> list[caldav.Event]:
+    def fetch_events(self, my_calendar: "caldav.Calendar | None" = None) -> "list[caldav.Event]":
         """Fetching the events from the calendar
         
         Returns:
@@ -417,12 +668,12 @@ class CalendarSchedule:
         # Get start and end date (for searching events)
         start_date, end_date = self._get_date_from_this_week_on()
 
-        # Search for events
+        # Search for events (no recurrence expansion, every lesson is its own non-recurring event)
         my_events = my_calendar.search(
             event=True,
             start=start_date,
             end=end_date,
-            expand=True
+            expand=False
         )
 
         # Debug
@@ -431,27 +682,127 @@ class CalendarSchedule:
 
         return my_events
 
+    def fetch_changed_events(self, my_calendar: "caldav.Calendar | None" = None) -> "list[caldav.CalendarObjectResource]":
+        """Fetching only the events that changed since the last call (WebDAV-Sync, RFC 6578)
+
+        The first call (or a call with a token the server doesn't know anymore) returns
+        every event of the calendar, the sync-token is saved to SYNC_TOKEN_FILE for the next call.
+
+        Returns:
+            my_events: the added or modified events (loaded in one calendar-multiget), then the deleted ones (without data)
+        """
+        from caldav.elements import dav
+
+        # Get the default my_calendar if None
+        if my_calendar is None:
+            my_calendar = self.get_or_create_calendar()
+
+        # Get the hrefs of what changed (deleted objects come back without an ETag), with a token
+        # of its own, so calling this doesn't hide the calendar edits from the next sync
+        changes, _ = self._get_sync_changes(my_calendar, token_key=f"fetch_changed_events {my_calendar.url}")
+        changed = [obj for obj in changes if dav.GetEtag.tag in obj.props]
+        deleted = [obj for obj in changes if dav.GetEtag.tag not in obj.props]
+
+        # Load the data of all the changed events in a single REPORT
+        my_events = list(my_calendar.multiget([obj.url for obj in changed])) if changed else []
+        my_events.extend(deleted)
+
+        # Debug
+        if self.debug:
+            print(f"\n\nDEBUG: my_events: {my_events}")
+
+        return my_events
+
+    def _get_sync_changes(self, my_calendar: "caldav.Calendar", token_key: str | None = None) -> "Tuple[list[caldav.CalendarObjectResource], bool]":
+        """Get the (not loaded) objects that changed since the saved sync-token of the calendar and save the new one
+
+        Args:
+            token_key (str, optional): what the token is saved under. Defaults to the calendar URL (the sync's token).
+
+        Returns:
+            changes, full: the objects, and whether they're the whole calendar (there was no usable token)
+        """
+        calendar_key = token_key or str(my_calendar.url)
+
+        # Load the sync-tokens of the last calls ({calendar_url: token})
+        try:
+            with open(SYNC_TOKEN_FILE, "rb") as fp:
+                sync_tokens = orjson.loads(fp.read())
+        except (FileNotFoundError, orjson.JSONDecodeError):
+            sync_tokens = {}
+        sync_token = sync_tokens.get(calendar_key)
+
+        # Ask the server for what changed since that token (everything if there's none)
+        try:
+            changes = my_calendar.objects_by_sync_token(sync_token=sync_token)
+            full = sync_token is None
+        except Exception as e:
+            if sync_token is None:
+                raise
+
+            # The server doesn't know the token anymore, start over
+            print(f"The sync-token was refused ({e}), fetching every event again.")
+            changes = my_calendar.objects_by_sync_token()
+            full = True
+
+        # Save the new sync-token (if the server gave one)
+        if changes.sync_token:
+            sync_tokens[calendar_key] = str(changes.sync_token)
+            tmp_path = f"{SYNC_TOKEN_FILE}.tmp"
+            with open(tmp_path, "wb") as fp:
+                fp.write(orjson.dumps(sync_tokens))
+            os.replace(tmp_path, SYNC_TOKEN_FILE)
+
+        # Debug
+        if self.debug:
+            print(f"\n\nDEBUG: sync_token: {changes.sync_token}")
+
+        return list(changes), full
+
+    def _get_edited_uids(self, my_calendar: "caldav.Calendar", synced_uids) -> set[str]:
+        """Get the UIDs of the synced events that were changed or deleted in the calendar since the
+        last sync (e.g. by hand), so they can be uploaded again"""
+        try:
+            changes, full = self._get_sync_changes(my_calendar)
+        except Exception as e:
+            print(f"There was a problem getting the calendar changes ({e}), only changed lessons will be uploaded.")
+            return set()
+
+        # Every event is saved as "<UID>.ics", so the UID is the href's last part
+        uids = {unquote(str(obj.url).rstrip("/").rsplit("/", 1)[-1]).removesuffix(".ics") for obj in changes}
+
+        # A whole listing of the calendar can't tell us what changed, only which synced events are gone
+        if full:
+            return set(synced_uids) - uids
+
+        return uids & set(synced_uids)
+
 
 # Local testing
 if __name__ == "__main__":
-    app = CalendarSchedule()
-    app.debug = False
+    parser = argparse.ArgumentParser(description="Sync the USARB schedule to your calendar")
+    parser.add_argument("--refresh", action="store_true", help="ignore the on-disk schedule cache")
+    parser.add_argument("--force-upload", action="store_true", help="upload every event again, even the unchanged ones")
+    args = parser.parse_args()
 
-    # app.get_date_from_this_week_on(mode="dates")
-    # app.get_or_create_calendar()
-    # my_events = app.fetch_events()
-    # print(my_events[0].data)
-    
-    # my_calendar = app.get_or_create_calendar()
-    # print(my_calendar)
+    with CalendarSchedule() as app:
+        app.debug = False
 
-    # my_principal = app.connect()
-    # print(my_principal)
-    
-    # print(datetime.now(timezone.utc))
-    
-    # app.parse_data_and_save_to_calendar()
-    
-    # print(app._get_lesson_date_and_time(10, 1, 2))
+        # app.get_date_from_this_week_on(mode="dates")
+        # app.get_or_create_calendar()
+        # my_events = app.fetch_events()
+        # print(my_events[0].data)
+
+        # my_calendar = app.get_or_create_calendar()
+        # print(my_calendar)
+
+        # my_principal = app.connect()
+        # print(my_principal)
+
+        # print(datetime.now(timezone.utc))
+
+        # app.parse_data_and_save_to_calendar()
+
+        # print(app._get_lesson_date_and_time(10, 1, 2))
 
-    app.sync_schedule()
\ No newline at end of file
+        app.sync_schedule(refresh=args.refresh, force_upload=args.force_upload)
\ No newline at end of file
@@ -1,5 +1,12 @@
+import os
+import re
+import json
+import time
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
-from bs4 import BeautifulSoup
 
 
 # Initialize the session
@@ -8,18 +15,142 @@ session = requests.Session()
 # URL of the main page
 url_main = "https://orar.usarb.md"
 
-# Get the home page (for cookies + csrf)
-r = session.get(url_main)
+# How long (seconds) a CSRF token is reused before the home page is fetched again
+CSRF_TTL = 600
+
+# The CSRF meta tag of the home page (the usual attribute order, anything else goes to BeautifulSoup)
+META_CSRF_RE = re.compile(rb'<meta\s+name="csrf-token"\s+content="([^"]+)"')
+
+# Statuses the server answers with when the CSRF token (or its session cookie) isn't valid anymore
+CSRF_ERROR_STATUSES = (400, 419)
+
+# CSRF token and group IDs caches (group IDs don't change during a semester),
+# the locks make parallel week fetches wait for one request instead of all sending their own
+_csrf_cache = {"token": None, "ts": 0.0}
+_csrf_lock = threading.Lock()
+_group_ids: dict[str, int] | None = None
+_group_ids_lock = threading.Lock()
+
+# ETag of the last lessons response: (group_id, semester, week) -> (etag, lessons)
+_lessons_validators: dict[tuple, tuple[str, dict]] = {}
+
+# Statuses meaning "the lessons didn't change since the sent ETag": the lessons are POSTed, so a compliant
+# server answers a matching If-None-Match with 412 (RFC 9110 13.1.2), 304 only comes from lenient ones
+NOT_MODIFIED_STATUSES = (304, 412)
 
 
-# Get the CSRF token
+# Default on-disk cache settings (can be changed with USARB_CACHE_DIR and USARB_CACHE_TTL, in seconds)
+DEFAULT_CACHE_DIR = "~/.cache/usarb"
+DEFAULT_CACHE_TTL = 3600
+
+# In-process cache in front of the on-disk one: (group, semester, week) -> (fetched_at, raw_schedule)
+# (the cached dicts are shared between callers, don't modify them)
+_memory_cache: dict[tuple[str, int, int], tuple[float, dict]] = {}
+
+
+# Get the CSRF token (cached for CSRF_TTL seconds)
 def get_csrf():
-    soup: BeautifulSoup = BeautifulSoup(r.text, "html.parser")
-    csrf: str = soup.find("meta", {"name": "csrf-token"})["content"]
-    return csrf
+    with _csrf_lock:
+        # Reuse the token while it's fresh
+        if _csrf_cache["token"] is not None and time.time() - _csrf_cache["ts"] < CSRF_TTL:
+            return _csrf_cache["token"]
+
+        # Get the home page (for cookies + csrf), only when a token is actually needed
+        r = session.get(url_main)
+
+        # Find the <meta name="csrf-token"> tag in the raw page, parse the whole page only if that misses
+        match = META_CSRF_RE.search(r.content)
+        if match:
+            csrf: str = match.group(1).decode()
+        else:
+            # bs4 is only needed here, import it on first use
+            from bs4 import BeautifulSoup
+
+            soup: BeautifulSoup = BeautifulSoup(r.text, "html.parser")
+            csrf: str = soup.find("meta", {"name": "csrf-token"})["content"]
+
+        _csrf_cache["token"] = csrf
+        _csrf_cache["ts"] = time.time()
+        return csrf
+
+
+# Forget the CSRF token, so the next get_csrf() fetches a new one
+def _invalidate_csrf():
+    with _csrf_lock:
+        _csrf_cache["token"] = None
+
+
+# POST with a CSRF token, if the server refuses the token get a new one and try once more
+def _post_with_csrf(url: str, data: dict, **kwargs):
+    response = session.post(url, data=data, **kwargs)
+
+    if response.status_code in CSRF_ERROR_STATUSES:
+        _invalidate_csrf()
+        data = {**data, "_csrf": get_csrf()}
+        response = session.post(url, data=data, **kwargs)
+
+    return response
+
+
+# Get the path of the cache file for a group, semester and week
+def _get_cache_path(group_name: str, semester: int, university_week: int) -> str:
+    cache_dir = os.path.expanduser(os.getenv("USARB_CACHE_DIR", DEFAULT_CACHE_DIR))
+    safe_group_name = "".join(c if c.isalnum() else "_" for c in group_name)
+    return os.path.join(cache_dir, f"{safe_group_name}_s{semester}_w{university_week}.json")
+
+
+# Cache the schedule in memory and on disk, keyed by (group, semester, week), set USARB_CACHE_TTL=0 or pass refresh=True to skip it
+def _cache_on_disk(fetch):
+    @functools.wraps(fetch)
+    def wrapper(your_group_name: str, semester: int = 1, university_week: int = 1, debug: bool = False, refresh: bool = False):
+        ttl = int(os.getenv("USARB_CACHE_TTL", DEFAULT_CACHE_TTL))
+        cache_key = (your_group_name, semester, university_week)
+        cache_path = _get_cache_path(your_group_name, semester, university_week)
+
+        # Return the cached schedule if it's still fresh (memory first, then disk)
+        if not refresh and ttl > 0:
+            fetched_at, cached = _memory_cache.get(cache_key, (0.0, None))
+            if cached is not None and time.time() - fetched_at < ttl:
+                return cached
+
+            try:
+                fetched_at = os.path.getmtime(cache_path)
+                if time.time() - fetched_at < ttl:
+                    with open(cache_path, "r") as fp:
+                        cached = json.load(fp)
+
+                    # Debugging
+                    if debug:
+                        print(f"Cache hit: {cache_path}")
+
+                    _memory_cache[cache_key] = (fetched_at, cached)
+                    return cached
+            except (OSError, ValueError):
+                # Missing or broken cache file, fetch it again
+                pass
+
+        # Fetch the schedule from the network
+        raw_schedule = fetch(your_group_name, semester=semester, university_week=university_week, debug=debug)
+        _memory_cache[cache_key] = (time.time(), raw_schedule)
+
+        # Save it in the cache (write and rename, so a reader never sees half a file)
+        if ttl > 0:
+            try:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                tmp_path = f"{cache_path}.tmp"
+                with open(tmp_path, "w") as fp:
+                    json.dump(raw_schedule, fp)
+                os.replace(tmp_path, cache_path)
+            except OSError as e:
+                print(f"Couldn't write the schedule cache \"{cache_path}\": {e}")
+
+        return raw_schedule
+
+    return wrapper
 
 
 # Get the schedule
+@_cache_on_disk
 def get_raw_schedule_data(your_group_name: str, semester: int = 1, university_week: int = 1, debug: bool = False):
     # Get CSRF token
     csrf = get_csrf()
@@ -46,31 +177,50 @@ def get_raw_schedule_data(your_group_name: str, semester: int = 1, university_we
         raise ValueError("Couldn't decode the JSON or find any data, check the input data.") from e
     
     
+# Get the schedule for many weeks at once (the requests run in parallel, they're network bound)
+def get_raw_schedule_data_for_weeks(your_group_name: str, weeks, semester: int = 1, max_workers: int = 8, debug: bool = False, refresh: bool = False):
+    # Make sure we can iterate the weeks more than once
+    weeks = list(weeks)
+    if not weeks:
+        return {}
+
+    # Fetch every week in its own thread, the order of the results follows the order of the weeks
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(weeks))) as executor:
+        raw_schedules = executor.map(
+            lambda week: get_raw_schedule_data(your_group_name, semester=semester, university_week=week, debug=debug, refresh=refresh),
+            weeks,
+        )
+        return dict(zip(weeks, raw_schedules))
+
+
 # Get the user's group ID by name
 def _get_groups_by_name(group_name: str, csrf: str, debug: bool = False):
-    # Get URL
-    url_groups = f"{url_main}/api/getGroups"
-    
-    # Prepare POST data
-    data = {
-        "_csrf": csrf,
-    }
-    
-    # POST to get groups
-    r_groups = session.post(url_groups, data=data)
+    global _group_ids
 
-    # Debugging
-    if debug:
-        print("Status groups:", r_groups.status_code)
-        print("Response groups:", r_groups.json())
-    
-    # Get the group ID from the response
-    for group in r_groups.json():
-        if group["Denumire"] == group_name:
-            return group["Id"]
+    with _group_ids_lock:
+        # Fetch the groups only once, then look them up by name
+        if _group_ids is None:
+            # Get URL
+            url_groups = f"{url_main}/api/getGroups"
+            
+            # Prepare POST data
+            data = {
+                "_csrf": csrf,
+            }
+            
+            # POST to get groups
+            r_groups = _post_with_csrf(url_groups, data)
+
+            # Debugging
+            if debug:
+                print("Status groups:", r_groups.status_code)
+                print("Response groups:", r_groups.json())
+            
+            # Index the group IDs by their name
+            _group_ids = {group["Denumire"]: group["Id"] for group in r_groups.json()}
 
-    # If the group is not found, return None
-    return None
+    # Get the group ID (if the group is not found, return None)
+    return _group_ids.get(group_name)
 
 
 # Get the user's lessons
@@ -78,16 +228,33 @@ def _get_lessons_data(data: dict, debug: bool = False):
     # Get URL
     url_lessons = f"{url_main}/api/getlessons"
 
+    # Send the ETag of the last response for this group/semester/week (if the server gave one),
+    # If-Modified-Since isn't sent, servers ignore it on a POST
+    validator_key = (data["gr"], data["sem"], data["week"])
+    etag, cached_lessons = _lessons_validators.get(validator_key, (None, None))
+    headers = {"If-None-Match": etag} if etag else {}
+
     # POST to get lessons
-    r_lessons = session.post(url_lessons, data=data)
+    r_lessons = _post_with_csrf(url_lessons, data, headers=headers)
 
     # Debugging
     if debug:
         print("Status lessons:", r_lessons.status_code)
-        print("Response lessons:", r_lessons.json())
+        if r_lessons.status_code not in NOT_MODIFIED_STATUSES:
+            print("Response lessons:", r_lessons.json())
+
+    # Nothing changed since the last response, no body to download or decode
+    if r_lessons.status_code in NOT_MODIFIED_STATUSES and cached_lessons is not None:
+        return cached_lessons
+
+    # Remember the ETag of this response for the next request
+    lessons = r_lessons.json()
+    etag = r_lessons.headers.get("ETag")
+    if etag:
+        _lessons_validators[validator_key] = (etag, lessons)
     
     # Return the lessons
-    return r_lessons.json()
+    return lessons
 
 
 # Local test
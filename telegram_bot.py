@@ -1,6 +1,8 @@
 import os
+import asyncio
 import logging
 
+from caldav.lib.error import DAVError
 from dotenv import load_dotenv
 from telegram import ForceReply, Update
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
@@ -23,11 +25,15 @@ load_dotenv()
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
 class TelegramBot:
+    # Text sent by /help
+    HELP_TEXT = "/sync - will sync your calendar properly"
 
     def __init__(self, app: CalendarSchedule) -> None:
         self.token = TELEGRAM_BOT_TOKEN
         self.app = app
         self.weekday: int = get_weekday_number()
+        # Only one sync may run at a time (they'd race on the calendar and sync_state.json)
+        self._sync_lock = asyncio.Lock()
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Send a message when the command /start is issued."""
@@ -38,13 +44,41 @@ class TelegramBot:
 
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Send a message when the command /help is issued."""
-        await update.message.reply_text("/sync - will sync your calendar properly")
+        await update.message.reply_text(self.HELP_TEXT)
 
     async def sync(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Sync the schedule to the calendar"""
-        await update.message.reply_text("🔵 Sync in process...")
-        self.app.sync_schedule()
-        await update.message.reply_text("✅ Succesfully synced!")
+        # Don't queue up another sync while one is still running
+        if self._sync_lock.locked():
+            await update.message.reply_text("⏳ Already running…")
+            return
+
+        async with self._sync_lock:
+            msg = await update.message.reply_text("🔵 Sync in process...")
+            # The user asked for a sync, so don't serve them a cached schedule (the upload stays incremental)
+            # (run in a thread, so the bot keeps answering other updates while it syncs)
+            try:
+                try:
+                    synced = await asyncio.to_thread(self.app.sync_schedule, refresh=True)
+                except DAVError as e:
+                    logger.warning("CalDAV sync failed (%s), reconnecting and retrying", e)
+                    synced = False
+
+                # Some events didn't make it (the CalDAV session was most likely dropped), reconnect and
+                # try once more, only the failed ones are uploaded again
+                if not synced:
+                    self.app.close()
+                    synced = await asyncio.to_thread(self.app.sync_schedule)
+            except Exception:
+                logger.exception("Sync failed")
+                await msg.edit_text("❌ Sync failed, try again later.")
+                return
+
+            # Edit the progress message instead of sending a second one
+            if synced:
+                await msg.edit_text("✅ Succesfully synced!")
+            else:
+                await msg.edit_text("⚠️ Some events couldn't be synced, they'll be tried again on the next /sync.")
 
     def run_bot(self):
         # Create the Application and pass it your bot's token.